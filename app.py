@@ -1,21 +1,40 @@
 import tkinter as tk
 import os
-from tkinter import filedialog
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import filedialog, font
 from  ttkbootstrap import Style
 import ttkbootstrap as ttk
 from PIL import Image, ImageTk
 import detect
 
+# Gallery layout on the canvas, in pixels
+CELL_WIDTH = 230
+CELL_HEIGHT = 250
+GROUP_PADDING = 10
+# Band at the top of each cell for the file name, the thumbnail goes below it
+LABEL_HEIGHT = 24
+
 
 class MyGUI():
     def __init__(self):    
         self.root = tk.Tk()
         self.root.geometry("1200x1000")
-        style = Style(theme='solar')
+        self.style = Style(theme='solar')
         self.selected_path = str()
         self.images = []
-        self.vars = []
+        self.selected = set()
         self.include_subfolders = ttk.BooleanVar()
+        self.results = queue.Queue()
+        self.thumbnail_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.thumbnails = queue.Queue()
+        self.render_generation = 0
+        self.pending_thumbnails = 0
+        self.thumbnail_futures = []
+        self.closing = threading.Event()
+        self.worker = None
         
         
         action_frm = ttk.Frame(self.root)
@@ -40,51 +59,91 @@ class MyGUI():
         canvas_frm = ttk.Frame(self.root)
         canvas_frm.pack(fill="both",expand=True,padx=100)
         
-        canvas = ttk.Canvas(canvas_frm)
-        scrollBar = ttk.Scrollbar(canvas_frm,orient='vertical',command=canvas.yview)
-        canvas.configure(yscrollcommand=scrollBar.set)
+        # Thumbnails are drawn as canvas items rather than one widget tree per image
+        self.canvas = ttk.Canvas(canvas_frm)
+        scrollBar = ttk.Scrollbar(canvas_frm,orient='vertical',command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=scrollBar.set)
         
         scrollBar.pack(side="right",fill="y")
-        canvas.pack(side="left",fill="both",expand=True) 
-        
-        self.photo_frm = ttk.Frame(canvas)    
-        self.photo_frm.bind(
-            "<Configure>",
-            lambda e: canvas.configure(
-                scrollregion=canvas.bbox("all")
-            )
-        )        
+        self.canvas.pack(side="left",fill="both",expand=True) 
         
         def _on_mousewheel(event):
-            canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+            self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
              
-        canvas.bind_all("<MouseWheel>", _on_mousewheel)  # For Windows
-        
-        canvas.create_window((0, 0), window=self.photo_frm, anchor="nw")
+        self.canvas.bind_all("<MouseWheel>", _on_mousewheel)  # For Windows
         
         self.del_btn = ttk.Button(self.root,text="DELETE",command=self.delete_selected,bootstyle="danger")
         self.del_btn.pack(anchor="s",pady=50)
         
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.root.mainloop()
         
 
             
     def process_folder(self):
+        # Detection runs on a worker thread so the Tk mainloop stays responsive
+        self.process_btn.config(state="disabled")
+        self.del_btn.config(state="disabled")
+        self.worker = threading.Thread(
+            target=self._detect_worker,
+            args=(self.selected_path, self.include_subfolders.get()),
+            daemon=True,
+        )
+        self.worker.start()
+        self.root.after(50, self._poll_results)
+
+    def _detect_worker(self, path, include_subfolders):
         try:
-            near_duplicates = detect.find_near_duplicates(self.selected_path, 0.7, 16, 16,include_SubFolders=self.include_subfolders.get())
+            near_duplicates = detect.find_near_duplicates(path, 0.7, 16, 16,include_SubFolders=include_subfolders, cancel=self.closing)
+            if self.closing.is_set():
+                return
             if near_duplicates:
                 print(f"Found {len(near_duplicates)} near-duplicate images in (threshold)")
                 # for a,b,s in near_duplicates:
                 #     print(f"{s:.2%} similarity: file 1: {a} - file 2: {b}")
-                groups = detect.group_similar_images(near_duplicates)
-                self.render_images(groups)
+                self.results.put(detect.group_similar_images(near_duplicates))
             else:
-                print(f"No near-duplicates found in {self.selected_path} (threshold)")
+                print(f"No near-duplicates found in {path} (threshold)")
+                self.results.put([])
         except OSError:
-            print(f"Couldn't open input directory {self.selected_path}")
+            print(f"Couldn't open input directory {path}")
+            self.results.put(None)
+        except Exception:
+            # Always answer the poller, otherwise the buttons stay disabled for good
+            print(f"Detection failed for {path}")
+            traceback.print_exc()
+            self.results.put(None)
+
+    def _poll_results(self):
+        if self.closing.is_set():
+            return
+        try:
+            groups = self.results.get_nowait()
+        except queue.Empty:
+            self.root.after(50, self._poll_results)
+            return
+
+        self.process_btn.config(state="normal")
+        self.del_btn.config(state="normal")
+        if groups is not None:
+            self.render_images(groups)
             
         
                     
+    def on_close(self):
+        # Stop the scan and the thumbnail decoding, the window goes away right now
+        self.closing.set()
+        self.thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+        self.root.withdraw()
+        self._wait_for_worker()
+
+    def _wait_for_worker(self):
+        # The worker commits the signatures cached so far on its way out, don't kill it mid-write
+        if self.worker is not None and self.worker.is_alive():
+            self.root.after(50, self._wait_for_worker)
+            return
+        self.root.destroy()
+
     def get_folder(self):
         path = filedialog.askdirectory(title="Select a folder")
         if path:
@@ -93,62 +152,120 @@ class MyGUI():
             
     def render_images(self, image_groups):
         self.clear_gallery()
+        generation = self.render_generation
 
+        num_per_row = 5
+        gallery_width = num_per_row * CELL_WIDTH + 2 * GROUP_PADDING
+        y = 0
         for group in image_groups:
-            group_frm = ttk.Frame(self.photo_frm,relief='solid')
-            group_frm.pack(fill='x', anchor='w')
-
-            num_per_row = 5
-            row_frm = None
+            group_height = -(-len(group) // num_per_row) * CELL_HEIGHT + 2 * GROUP_PADDING
+            self.canvas.create_rectangle(0, y, gallery_width, y + group_height, outline=self.style.colors.border)
 
+            # Thumbnails are decoded on the pool and handed back to the Tk thread through a queue
             for i, path in enumerate(group):
-                if i % num_per_row == 0:
-                    row_frm = ttk.Frame(group_frm)
-                    row_frm.pack(fill='x', anchor='w', pady=5)
+                cell = (
+                    GROUP_PADDING + (i % num_per_row) * CELL_WIDTH,
+                    y + GROUP_PADDING + (i // num_per_row) * CELL_HEIGHT,
+                )
+                future = self.thumbnail_pool.submit(self._decode_thumbnail, path)
+                future.add_done_callback(
+                    lambda f, cell=cell, path=path: self.thumbnails.put((generation, cell, path, f))
+                )
+                self.thumbnail_futures.append(future)
+                self.pending_thumbnails += 1
+            y += group_height + GROUP_PADDING
 
-                img = Image.open(path)
-                img.thumbnail((200, 200))
-                img_tk = ImageTk.PhotoImage(img)
-                self.images.append((img_tk,path))  # Prevent garbage collection
+        self.canvas.configure(scrollregion=(0, 0, gallery_width, y))
+        self.root.after(10, self._drain_thumbnails, generation)
 
-                var = tk.BooleanVar()
-                self.vars.append(var)
+    def _decode_thumbnail(self, path):
+        img = Image.open(path)
+        # Let libjpeg decode at a reduced scale before downsampling to the thumbnail
+        img.draft("RGB", (400, 400))
+        img.thumbnail((200, 200), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        return img
 
-                frame = ttk.Frame(row_frm, padding=10, relief="solid", borderwidth=2)
-                frame.pack(side='left', padx=5)
-                
-                infobox = ttk.Frame(frame)
-                chk = tk.Checkbutton(infobox, variable=var)
-                chk.grid(row=0, column=0)
-                path_label = ttk.Label(infobox,text=path.split('\\')[-1])
-                path_label.grid(row = 0, column= 1,sticky="ew")
-                
-                infobox.pack(anchor="n")
+    def _drain_thumbnails(self, generation):
+        # A newer render has taken over, it runs its own drain
+        if generation != self.render_generation:
+            return
 
-                lbl = tk.Label(frame, image=img_tk)
-                lbl.pack()
-                
-                def toggle(var=var):
-                    var.set(not var.get())
-                    
-                frame.bind("<Button-1>", lambda e, v=var: toggle(v))
-                lbl.bind("<Button-1>", lambda e, v=var: toggle(v))
+        while True:
+            try:
+                item_generation, cell, path, future = self.thumbnails.get_nowait()
+            except queue.Empty:
+                break
+            if item_generation != generation:
+                continue
+            self.pending_thumbnails -= 1
+            # A single bad image (unreadable, decompression bomb, ...) must not stop the rest of the gallery
+            try:
+                self._add_thumbnail(cell, path, future.result())
+            except Exception as e:
+                print(f"Couldn't open image {path}: {e}")
+
+        if self.pending_thumbnails > 0:
+            self.root.after(10, self._drain_thumbnails, generation)
+
+    def _add_thumbnail(self, cell, path, img):
+        x, y = cell
+        img_tk = ImageTk.PhotoImage(img)
+        img.close()
+        index = len(self.images)
+        self.images.append((img_tk,path))  # Prevent garbage collection
+
+        # Every item of a thumbnail shares a tag, so clicking any of them toggles its selection
+        tag = f"thumbnail{index}"
+        self.canvas.create_text(
+            x + CELL_WIDTH // 2, y, text=self._elide(os.path.basename(path), CELL_WIDTH - 2 * GROUP_PADDING),
+            anchor="n", fill=self.style.colors.fg, tags=tag,
+        )
+        self.canvas.create_image(x + CELL_WIDTH // 2, y + LABEL_HEIGHT, image=img_tk, anchor="n", tags=tag)
+        border = self.canvas.create_rectangle(
+            x + 2, y - 2, x + CELL_WIDTH - 2, y + CELL_HEIGHT - 2,
+            outline=self.style.colors.danger, width=3, state="hidden",
+        )
+        self.canvas.tag_bind(tag, "<Button-1>", lambda e: self.toggle_selected(index, border))
+
+    def _elide(self, text, width):
+        # Keep the file name on a single line, cutting the middle so the extension stays visible
+        label_font = font.nametofont("TkDefaultFont")
+        if label_font.measure(text) <= width:
+            return text
+        head, tail = text[:len(text) // 2], text[len(text) // 2:]
+        while head and label_font.measure(f"{head}…{tail}") > width:
+            head, tail = head[:-1], tail[1:]
+        return f"{head}…{tail}"
+
+    def toggle_selected(self, index, border):
+        if index in self.selected:
+            self.selected.remove(index)
+            self.canvas.itemconfigure(border, state="hidden")
+        else:
+            self.selected.add(index)
+            self.canvas.itemconfigure(border, state="normal")
                 
                 
     def clear_gallery(self):
-        for widget in self.photo_frm.winfo_children():
-            widget.destroy()
+        self.canvas.delete("all")
         self.images.clear()
-        self.vars.clear()    
+        self.selected.clear()
+        self.render_generation += 1
+        self.pending_thumbnails = 0
+        # Don't decode thumbnails of a gallery that is gone, their results would be dropped as stale anyway
+        for future in self.thumbnail_futures:
+            future.cancel()
+        self.thumbnail_futures.clear()
 
     def delete_selected(self):
-        for image, var in zip(self.images, self.vars):
-            path = image[1]
-            if var.get():
-                print("delete ",path)
-                os.remove(path) 
+        for index in sorted(self.selected):
+            path = self.images[index][1]
+            print("delete ",path)
+            os.remove(path) 
                 
         self.process_folder()      
         
         
-gui = MyGUI()
\ No newline at end of file
+if __name__ == "__main__":
+    # Guarded so detection worker processes can re-import this module under spawn
+    gui = MyGUI()
\ No newline at end of file
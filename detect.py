@@ -1,15 +1,145 @@
 import argparse
+import multiprocessing
+import sqlite3
 import sys
-from os import listdir
-from os.path import isfile, join
+import threading
+from os import listdir, stat
+from os.path import abspath, expanduser, join, splitext
 from os import walk
-from typing import Dict, List, Tuple
+from stat import S_ISREG
+from typing import Dict, Iterator, List, Optional, Tuple
 from collections import defaultdict
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-import imagehash
 import numpy as np
 from PIL import Image
 
+# OpenCV is optional, it provides a faster decode and resize for the signature calculation
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# Numba is optional, it compiles signature packing and candidate pair verification into native loops
+try:
+    from numba import njit, prange
+    from numba.extending import intrinsic
+except ImportError:
+    njit = None
+
+CACHE_FILE = expanduser("~/.dupenuke_cache.db")
+# Bump when the cache table layout changes, older tables are dropped on open
+CACHE_VERSION = 2
+# Signatures from different resize pipelines differ by several bits, so the cache keeps them apart
+SIGNATURE_PIPELINE = "cv2-inter-area" if cv2 is not None else "pil-lanczos"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff", ".heic"}
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _pack_bits(signature: np.ndarray) -> np.ndarray:
+        # Same bit order as np.packbits, so packed signatures are interchangeable between both paths
+        words = np.zeros((signature.size + 63) // 64 * 8, dtype=np.uint8)
+        for i in range(signature.size):
+            if signature[i]:
+                words[i >> 3] |= np.uint8(0x80 >> (i & 7))
+        return words.view(np.uint64)
+else:
+    def _pack_bits(signature: np.ndarray) -> np.ndarray:
+        packed = np.packbits(signature)
+        words = np.zeros(-(-packed.size // 8) * 8, dtype=np.uint8)
+        words[:packed.size] = packed
+        return words.view(np.uint64)
+
+
+if njit is not None:
+    @intrinsic
+    def _ctpop(typingctx, x):
+        def codegen(context, builder, signature, args):
+            return builder.ctpop(args[0])
+        return x(x), codegen
+
+    @njit(parallel=True, cache=True)
+    def _hamming_distances(sigs: np.ndarray, ia: np.ndarray, ib: np.ndarray, max_distance: int) -> np.ndarray:
+        hd = np.empty(len(ia), dtype=np.int32)
+        for k in prange(len(ia)):
+            h = 0
+            for w in range(sigs.shape[1]):
+                h += np.int64(_ctpop(sigs[ia[k], w] ^ sigs[ib[k], w]))
+                if h > max_distance:
+                    break
+            hd[k] = h
+        return hd
+elif hasattr(np, "bitwise_count"):
+    # numpy >= 2.0 ships a vectorized popcount
+    def _hamming_distances(sigs: np.ndarray, ia: np.ndarray, ib: np.ndarray, max_distance: int) -> np.ndarray:
+        # Word by word, only pairs still within max_distance get their next word counted
+        hd = np.zeros(len(ia), dtype=np.int32)
+        active = np.arange(len(ia))
+        for w in range(sigs.shape[1]):
+            hd[active] += np.bitwise_count(np.bitwise_xor(sigs[ia[active], w], sigs[ib[active], w]))
+            active = active[hd[active] <= max_distance]
+            if not active.size:
+                break
+        return hd
+else:
+    # Python ints popcount a whole signature in one call, without any numpy dispatch per pair
+    def _hamming_distances(sigs: np.ndarray, ia: np.ndarray, ib: np.ndarray, max_distance: int) -> np.ndarray:
+        sig_ints = [int.from_bytes(sig.tobytes(), "big") for sig in sigs]
+        return np.fromiter(((sig_ints[a] ^ sig_ints[b]).bit_count() for a, b in zip(ia.tolist(), ib.tolist())),
+                           dtype=np.int32, count=len(ia))
+
+
+def hamming_distances(sigs: np.ndarray, ia: np.ndarray, ib: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    Calculate the Hamming distance for a batch of signature pairs, giving up on a pair once it exceeds max_distance
+
+    Args:
+        sigs: packed signatures as a (N, words) uint64 matrix
+        ia: row indices in sigs of the first signature of every pair
+        ib: row indices in sigs of the second signature of every pair
+        max_distance: distance beyond which the exact value of a pair is no longer needed
+
+    Returns:
+        Numpy array with the Hamming distance of every pair, pairs beyond max_distance only get a partial count above it
+    """
+    return _hamming_distances(sigs, ia, ib, max_distance)
+
+
+def pack_signature(signature: np.ndarray) -> np.ndarray:
+    """
+    Pack a boolean signature into 64-bit words
+
+    Args:
+        signature: unpacked signature as returned by calculate_signature
+
+    Returns:
+        Signature as a Numpy array of uint64 words, zero padded to a whole number of words
+    """
+    return _pack_bits(signature)
+
+
+def _is_truncated_jpeg(image_file: str) -> bool:
+    """
+    Check whether a file is a JPEG that stops before its end of image marker
+
+    Args:
+        image_file: the file (path as string) to check
+
+    Returns:
+        True if the file starts like a JPEG but has no end of image marker near its end
+    """
+    with open(image_file, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return False
+        # Allow for a little padding after the marker, as some encoders write
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - 32))
+        return b"\xff\xd9" not in f.read()
+
 
 def calculate_signature(image_file: str, hash_size: int) -> np.ndarray:
     """ 
@@ -22,16 +152,186 @@ def calculate_signature(image_file: str, hash_size: int) -> np.ndarray:
     Returns:
         Image signature as Numpy n-dimensional array or None if the file is not a PIL recognized image
     """
-    pil_image = Image.open(image_file).convert("L").resize(
-                        (hash_size+1, hash_size),
-                        Image.Resampling.LANCZOS)
-    dhash = imagehash.dhash(pil_image, hash_size)
-    signature = dhash.hash.flatten()
-    pil_image.close()
-    return signature
+    if cv2 is not None:
+        # OpenCV fills in the missing part of a truncated JPEG, PIL raises an IOError for it instead
+        image = None
+        if not _is_truncated_jpeg(image_file):
+            image = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            # Formats OpenCV can't read (GIF, HEIC, ...) and truncated JPEGs are decoded by PIL instead
+            with Image.open(image_file) as pil_image:
+                image = np.asarray(pil_image.convert("L"), dtype=np.uint8)
+        # All files share one resize, so signatures compare the same whichever decoder read them
+        pixels = cv2.resize(image, (hash_size+1, hash_size), interpolation=cv2.INTER_AREA)
+    else:
+        pil_image = Image.open(image_file).convert("L").resize(
+                            (hash_size+1, hash_size),
+                            Image.Resampling.LANCZOS)
+        pixels = np.asarray(pil_image, dtype=np.uint8)
+        pil_image.close()
+    diff = pixels[:, 1:] > pixels[:, :-1]
+    return diff.ravel()
 
-        
-def find_near_duplicates(input_dir: str, threshold: float, hash_size: int, bands: int,include_SubFolders:bool ) -> List[Tuple[str, str, float]]:
+
+def calculate_signature_safe(image_file: str, hash_size: int) -> Tuple[str, Optional[np.ndarray]]:
+    """
+    Calculate the packed dhash signature of a given file, for use in a worker process
+
+    Args:
+        image_file: the image (path as string) to calculate the signature for
+        hash_size: hash size to use, signatures will be of length hash_size^2
+
+    Returns:
+        Tuple of the image file and its packed signature, or None as signature if the file is not a PIL recognized image
+    """
+    try:
+        return image_file, pack_signature(calculate_signature(image_file, hash_size))
+    except IOError:
+        return image_file, None
+
+
+@dataclass
+class SignatureTable:
+    """
+    Packed signatures of all scanned images, kept in one contiguous matrix so pairs can be compared in bulk
+
+    Attributes:
+        words: packed signatures as a (capacity, words) uint64 matrix, preallocated with a row for every candidate file
+        paths: image file of every row in use, the row index is the integer id of the image
+    """
+    words: np.ndarray
+    paths: List[str] = field(default_factory=list)
+
+    def add(self, path: str, signature: np.ndarray) -> int:
+        """
+        Add a packed signature to the next free row of the table
+
+        Args:
+            path: image file the signature belongs to
+            signature: packed signature as returned by pack_signature
+
+        Returns:
+            The integer id of the image, its row index in words
+        """
+        file_id = len(self.paths)
+        self.words[file_id] = signature
+        self.paths.append(path)
+        return file_id
+
+    @property
+    def used(self) -> np.ndarray:
+        """
+        The rows of words holding a signature, as a (len(paths), words) matrix
+        """
+        return self.words[:len(self.paths)]
+
+
+class SignatureCache:
+    """
+    Best-effort on-disk cache of packed signatures, keyed by (path, mtime, size) per hash size and resize pipeline
+
+    Any sqlite error disables the cache for the rest of the scan, signatures are then simply calculated again.
+    """
+
+    def __init__(self, hash_size: int, cache_file: str = CACHE_FILE):
+        """
+        Open the cache, creating it if needed
+
+        Args:
+            hash_size: hash size of the signatures looked up and stored
+            cache_file: path of the sqlite database holding the cached signatures
+        """
+        self.hash_size = hash_size
+        self.db: Optional[sqlite3.Connection] = None
+        try:
+            self.db = sqlite3.connect(cache_file)
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS sigs")
+                self.db.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS sigs (
+                                path TEXT, mtime INTEGER, size INTEGER, hsize INTEGER, pipeline TEXT, sig BLOB,
+                                PRIMARY KEY (path, hsize, pipeline))""")
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def _disable(self, error: sqlite3.Error):
+        print(f"Signature cache unavailable, continuing without it: {error}")
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+
+    def get(self, key: Tuple[str, int, int]) -> Optional[np.ndarray]:
+        """
+        Look up the signature of a file
+
+        Args:
+            key: (absolute path, mtime in ns, size) of the file
+
+        Returns:
+            The packed signature, or None if the file isn't cached or changed since
+        """
+        if self.db is None:
+            return None
+        path, mtime, size = key
+        try:
+            row = self.db.execute("SELECT sig FROM sigs WHERE path = ? AND hsize = ? AND pipeline = ? AND mtime = ? AND size = ?",
+                                  (path, self.hash_size, SIGNATURE_PIPELINE, mtime, size)).fetchone()
+        except sqlite3.Error as e:
+            self._disable(e)
+            return None
+        return None if row is None else np.frombuffer(row[0], dtype=np.uint64)
+
+    def put(self, key: Tuple[str, int, int], signature: np.ndarray):
+        """
+        Store the signature of a file
+
+        Args:
+            key: (absolute path, mtime in ns, size) of the file
+            signature: packed signature as returned by pack_signature
+        """
+        if self.db is None:
+            return
+        path, mtime, size = key
+        try:
+            self.db.execute("INSERT OR REPLACE INTO sigs VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, mtime, size, self.hash_size, SIGNATURE_PIPELINE, signature.tobytes()))
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def close(self):
+        """
+        Commit the stored signatures and close the cache
+        """
+        if self.db is None:
+            return
+        try:
+            self.db.commit()
+        except sqlite3.Error as e:
+            print(f"Couldn't save signature cache: {e}")
+        finally:
+            self.db.close()
+            self.db = None
+
+
+def iter_images(input_dir: str, include_subfolders: bool) -> Iterator[str]:
+    """
+    Iterate over the files in a directory that have an image extension
+
+    Args:
+        input_dir: Directory to look for images in
+        include_subfolders: Whether to include subfolders in the directory
+
+    Returns:
+        Iterator over the image file paths, sorted by name within each directory
+    """
+    walker = walk(input_dir) if include_subfolders else [(input_dir, [], listdir(input_dir))]
+    for root, _, files in walker:
+        for f in sorted(files):
+            if splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                yield join(root, f)
+
+
+def find_near_duplicates(input_dir: str, threshold: float, hash_size: int, bands: int,include_SubFolders:bool, cancel: Optional[threading.Event] = None) -> List[Tuple[str, str, float]]:
     """
     Find near-duplicate images
     
@@ -41,71 +341,103 @@ def find_near_duplicates(input_dir: str, threshold: float, hash_size: int, bands
         hash_size: Hash size to use, signatures will be of length hash_size^2
         bands: The number of bands to use in the locality sensitve hashing process
         include_SubFolders: Whether to include subfolders in the directory
+        cancel: Optional event to stop the scan early, signatures calculated so far are still cached
         
     Returns:
         A list of near-duplicates found. Near duplicates are encoded as a triple: (filename_A, filename_B, similarity)
+        An empty list if the scan was cancelled
+
+    Raises:
+        ValueError: if hash_size^2 can't be split into bands of a whole number of bytes
     """
-    rows: int = int(hash_size**2/bands)
-    signatures = dict()
-    hash_buckets_list: List[Dict[str, List[str]]] = [dict() for _ in range(bands)]
+    rows: int = hash_size**2 // bands
+    # Bands are keyed on the bit-packed signature, so each band must span whole bytes
+    if rows * bands != hash_size**2 or rows % 8 != 0:
+        raise ValueError(f"hash_size^2 / bands must be a multiple of 8, got {hash_size}^2 / {bands}")
+    hash_buckets_list: List[Dict[bytes, List[int]]] = [dict() for _ in range(bands)]
     
-    # Build a list of candidate files in given input_dir
-    file_list = list()
-    if(include_SubFolders):
-        for root, dirs, files in walk(input_dir):
-            for f in files:
-                full_path = join(root, f)
-                if isfile(full_path):
-                    file_list.append(full_path)
-                    
-    else:
-        file_list = [join(input_dir, f) for f in listdir(input_dir) if isfile(join(input_dir, f))]
-                   
-    # Iterate through all files in input directory
-    for fh in file_list:
-        try:
-            
-            signature = calculate_signature(fh, hash_size)
-        except IOError:
-            print("Not a PIL image encountered")
-            # Not a PIL image, skip this file
-            continue
-
-        # Keep track of each image's signature
-        signatures[fh] = np.packbits(signature)
-        
-        # Locality Sensitive Hashing
-        for i in range(bands):
-            signature_band = signature[i*rows:(i+1)*rows]
-            signature_band_bytes = signature_band.tobytes()
-            if signature_band_bytes not in hash_buckets_list[i]:
-                hash_buckets_list[i][signature_band_bytes] = list()
-            hash_buckets_list[i][signature_band_bytes].append(fh)
-
-    # Build candidate pairs based on bucket membership
-    candidate_pairs = set()
+    # Look up signatures of image files unchanged since they were last seen
+    cache = SignatureCache(hash_size)
+    try:
+        file_list = list()
+        file_keys = dict()
+        cached_signatures = dict()
+        for fh in iter_images(input_dir, include_SubFolders):
+            try:
+                file_stat = stat(fh)
+            except OSError:
+                # Broken link, skip this file
+                continue
+            # Skip anything that isn't a regular, non-empty file without opening it
+            if not S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+                continue
+            file_list.append(fh)
+            file_keys[fh] = (abspath(fh), file_stat.st_mtime_ns, file_stat.st_size)
+            cached = cache.get(file_keys[fh])
+            if cached is not None:
+                cached_signatures[fh] = cached
+
+        # Calculate the remaining signatures across worker processes, keeping the file_list order
+        table = SignatureTable(np.empty((len(file_list), -(-hash_size**2 // 64)), dtype=np.uint64))
+        # Spawn rather than fork, detection may run from a thread of a multi-threaded process such as the GUI
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as executor:
+            uncached_files = [fh for fh in file_list if fh not in cached_signatures]
+            # Small chunks, a cancelled scan still waits for the chunks already handed to the workers
+            calculated = executor.map(partial(calculate_signature_safe, hash_size=hash_size), uncached_files, chunksize=2)
+            for fh in file_list:
+                if cancel is not None and cancel.is_set():
+                    # Drop the queued work, the pool then only waits for the chunks already running
+                    executor.shutdown(cancel_futures=True)
+                    return []
+                if fh in cached_signatures:
+                    packed = cached_signatures.pop(fh)
+                else:
+                    _, packed = next(calculated)
+                    if packed is None:
+                        print("Not a PIL image encountered")
+                        # Not a PIL image, skip this file
+                        continue
+                    cache.put(file_keys[fh], packed)
+
+                # Keep track of each image's signature, images are referred to by their integer id from here on
+                file_id = table.add(fh, packed)
+
+                # Locality Sensitive Hashing
+                packed_bytes = packed.view(np.uint8)
+                for i in range(bands):
+                    signature_band_bytes = packed_bytes[i*rows//8:(i+1)*rows//8].tobytes()
+                    if signature_band_bytes not in hash_buckets_list[i]:
+                        hash_buckets_list[i][signature_band_bytes] = list()
+                    hash_buckets_list[i][signature_band_bytes].append(file_id)
+    finally:
+        cache.close()
+
+    # Build candidate pairs based on bucket membership, ids within a bucket are ascending
+    # Every pair is encoded as a single int64 ia * N + ib so duplicates across bands can be dropped in bulk
+    num_files = len(table.paths)
+    pair_batches: List[np.ndarray] = list()
     for hash_buckets in hash_buckets_list:
         for hash_bucket in hash_buckets.values():
             if len(hash_bucket) > 1:
-                hash_bucket = sorted(hash_bucket)
-                for i in range(len(hash_bucket)):
-                    for j in range(i+1, len(hash_bucket)):
-                        candidate_pairs.add(
-                            tuple([hash_bucket[i],hash_bucket[j]])
-                        )
-
-    # Check candidate pairs for similarity
+                ids = np.fromiter(hash_bucket, dtype=np.int64, count=len(hash_bucket))
+                i, j = np.triu_indices(len(ids), 1)
+                pair_batches.append(ids[i] * num_files + ids[j])
+
+    # Check all candidate pairs for similarity at once
     near_duplicates = list()
-    for cpa, cpb in candidate_pairs:
-        hd = int(np.bitwise_xor(
-                np.unpackbits(signatures[cpa]), 
-                np.unpackbits(signatures[cpb])
-        ).sum())
-
-        similarity = (hash_size**2 - hd) / hash_size**2        
-        if similarity > threshold:
-            near_duplicates.append((cpa, cpb, similarity))
-            
+    if pair_batches:
+        # similarity > threshold holds exactly for Hamming distances up to max_hd, so only those are worked out
+        total = hash_size * hash_size
+        max_hd = total - int(np.floor(threshold * total)) - 1
+        candidate_pairs = np.unique(np.concatenate(pair_batches))
+        ia, ib = np.divmod(candidate_pairs, num_files)
+        hd = hamming_distances(table.used, ia, ib, max_hd)
+
+        for k in np.flatnonzero(hd <= max_hd):
+            similarity = (total - int(hd[k])) / total
+            near_duplicates.append((table.paths[ia[k]], table.paths[ib[k]], similarity))
+
+
     # Sort near-duplicates by descending similarity and return
     near_duplicates.sort(key=lambda x:x[2], reverse=True)
     return near_duplicates
@@ -121,41 +453,45 @@ def group_similar_images(near_duplicates):
     Returns:
         List of lists, where each inner list is a group of similar images.
     """
-    parent = {}
+    images = []
+    image_ids = {}
+    parent = []
+    size = []
 
-    # Initialize parent pointers for all images found in pairs
+    # Initialize a set for an image the first time it is seen and return its id
     def make_set(x):
-        if x not in parent:
-            parent[x] = x
+        if x not in image_ids:
+            image_ids[x] = len(images)
+            images.append(x)
+            parent.append(len(parent))
+            size.append(1)
+        return image_ids[x]
 
     # Find root leader of group containing x
     def find(x):
         while parent[x] != x:
-            parent[x] = parent[parent[x]]  # path compression
+            parent[x] = parent[parent[x]]  # path halving
             x = parent[x]
         return x
 
-    # Union groups of x and y
+    # Union groups of x and y, attaching the smaller group to the larger one
     def union(x, y):
         root_x = find(x)
         root_y = find(y)
         if root_x != root_y:
+            if size[root_x] < size[root_y]:
+                root_x, root_y = root_y, root_x
             parent[root_y] = root_x
+            size[root_x] += size[root_y]
 
-    # Initialize sets for all images in near_duplicates
-    for a, b, _ in near_duplicates:
-        make_set(a)
-        make_set(b)
-
-    # Union similar image pairs
+    # Initialize sets and union similar image pairs in a single pass
     for a, b, _ in near_duplicates:
-        union(a, b)
+        union(make_set(a), make_set(b))
 
     # Group images by their root leader
     clusters = defaultdict(list)
-    for img in parent:
-        root = find(img)
-        clusters[root].append(img)
+    for image_id, img in enumerate(images):
+        clusters[find(image_id)].append(img)
 
     return list(clusters.values())
 
@@ -185,6 +521,8 @@ def main(argv):
                 print(f"{s:.2%} similarity: file 1: {a} - file 2: {b}")
         else:
             print(f"No near-duplicates found in {input_dir} (threshold {threshold:.2%})")
+    except ValueError as e:
+        parser.error(str(e))
     except OSError:
         print(f"Couldn't open input directory {input_dir}")
                     